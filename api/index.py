@@ -1,19 +1,62 @@
+import io
 import json
-import requests
+import anyio
+import httpx
+import asyncio
 import base64
-import time
+import hashlib
+import math
 import os
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field, ValidationError
+import diskcache
+import msgspec
+import orjson
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from typing import List, Optional, Dict, Any, Tuple
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from pypdf import PdfReader, PdfWriter
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from pydantic import AnyHttpUrl, BaseModel, Field
 
 # --- CONFIGURATION (Reads from render Environment Variables) ---
 # The API_KEY is read securely from the environment variable named "API_KEY" set in render.
 API_KEY = os.environ.get("API_KEY", "") 
 GEMINI_MODEL = "gemini-2.5-flash-preview-09-2025"
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={API_KEY}"
+GEMINI_UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+# Bump whenever the prompt or response schema changes so stale cached extractions are not reused.
+PROMPT_VERSION = "v3"
+EXTRACTION_CACHE_DIR = os.environ.get("EXTRACTION_CACHE_DIR", "/tmp/bill_cache")
+EXTRACTION_CACHE_TTL = 7 * 24 * 60 * 60  # one week, in seconds
+FILES_API_MIN_BYTES = 1024 * 1024  # smaller documents are sent inline, where an upload round trip isn't worth it
+FILES_API_URI_TTL = 47 * 60 * 60  # Gemini deletes uploaded files after 48 hours
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))  # in-flight Gemini calls per worker
+MAX_FANOUT_PAGES = int(os.environ.get("MAX_FANOUT_PAGES", "20"))  # longer PDFs are sent whole instead of per page
+FANOUT_MAX_SIZE_RATIO = 3  # split page PDFs may total at most this multiple of the original document
+LLM_MAX_ATTEMPTS = 3
+LLM_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+LLM_MAX_RETRY_WAIT = 30.0  # upper bound in seconds for a single backoff, including Retry-After
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "64"))  # worker threads for CPU-bound steps
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "90"))  # seconds an idle pooled connection is kept
+MAX_DOWNLOAD_BYTES = int(os.environ.get("MAX_DOWNLOAD_BYTES", str(25 * 1024 * 1024)))  # larger documents are rejected with 413
+DOWNLOAD_CACHE_TTL = 5 * 60  # seconds a downloaded document is reused for repeat submissions of its URL
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes read per network chunk while streaming downloads
 # --- END CONFIGURATION ---
 
+# Content-addressed store of raw LLM JSON responses, shared across workers on the same disk.
+_EXTRACTION_CACHE = diskcache.Cache(EXTRACTION_CACHE_DIR)
+# Uploaded files belong to the project behind the API key; a digest of the key scopes cached file URIs
+# to it without writing the key itself to disk.
+_API_KEY_ID = hashlib.sha256(API_KEY.encode()).hexdigest()[:16]
+
+# Short-lived in-process memo of recent downloads by URL, bounded by total document bytes.
+_DOWNLOAD_CACHE: TTLCache = TTLCache(
+    maxsize=DOWNLOAD_CACHE_MAX_BYTES, ttl=DOWNLOAD_CACHE_TTL, getsizeof=lambda entry: len(entry[0])
+)
+_DOWNLOADS_IN_FLIGHT: Dict[str, "asyncio.Task[Tuple[bytes, str]]"] = {}
+
 
 # --- PYDANTIC SCHEMA DEFINITIONS ---
 
@@ -54,169 +97,505 @@ class ExtractionResponse(BaseModel):
 
 class ExtractionRequest(BaseModel):
     """The required input request body."""
-    document: str
+    # Parsed by pydantic-core's URL validator, so non-http(s) or malformed URLs are rejected with 422 up front.
+    # AnyHttpUrl rather than HttpUrl: the latter caps length at 2083, which long pre-signed URLs exceed.
+    document: AnyHttpUrl
+
+
+# --- MSGSPEC DECODE MIRRORS ---
+# Mirror the LLM-facing Pydantic models above (keep the fields in sync). The Pydantic models still
+# generate the responseSchema sent to Gemini; these structs only decode and validate its reply,
+# using a decoder specialised for this exact shape.
+
+class _BillItemStruct(msgspec.Struct):
+    item_name: str
+    item_amount: float
+    item_rate: float
+    item_quantity: float
+
+class _PagewiseLineItemStruct(msgspec.Struct):
+    page_no: str
+    page_type: str
+    bill_items: List[_BillItemStruct]
+
+class _LLMExtractionOutputStruct(msgspec.Struct):
+    pagewise_line_items: List[_PagewiseLineItemStruct]
+    document_final_total: float
+
+_LLM_OUTPUT_DECODER = msgspec.json.Decoder(_LLMExtractionOutputStruct)
+
+
+# --- STATIC LLM REQUEST PARTS (built once at import) ---
+
+_RESPONSE_SCHEMA: Dict[str, Any] = LLMExtractionOutput.model_json_schema()
+
+_SYSTEM_PROMPT = (
+    "You are a highly accurate invoice data extraction specialist. "
+    "Analyze the entire multi-page bill document and extract ALL line item details, quantities, rates, and amounts. "
+    "Strictly adhere to the provided JSON schema for the output. "
+    "The 'page_type' must be one of: 'Bill Detail', 'Final Bill', or 'Pharmacy'. "
+    "The 'document_final_total' must be the exact grand total amount written on the entire bill document."
+)
+
+# Everything in the Gemini payload except the per-document contents
+_BASE_PAYLOAD: Dict[str, Any] = {
+    "generationConfig": {
+        "responseMimeType": "application/json",
+        "responseSchema": _RESPONSE_SCHEMA
+    },
+    "systemInstruction": {"parts": [{"text": _SYSTEM_PROMPT}]}
+}
+
+# Leading bytes that identify each document format Gemini accepts
+_MAGIC_PREFIXES = (
+    (b"%PDF-", "application/pdf"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+)
+# ISO-BMFF brands (bytes 8-12, after the 'ftyp' box type) used by HEIC/HEIF images
+_HEIF_BRANDS = {b"heic": "image/heic", b"heix": "image/heic", b"heif": "image/heif", b"mif1": "image/heif"}
+_SNIFF_LENGTH = 12
 
 
 # --- HELPER FUNCTIONS ---
 
-def _download_file_to_base64(url: str) -> str:
-    """Downloads the file and encodes it as Base64 for the Gemini API."""
+def _sniff_mime_type(file_bytes: bytes) -> str:
+    """Identifies the document format from its magic bytes; unsupported formats are rejected with 415."""
+    head = bytes(file_bytes[:_SNIFF_LENGTH])
+    for magic, mime_type in _MAGIC_PREFIXES:
+        if head.startswith(magic):
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in _HEIF_BRANDS:
+        return _HEIF_BRANDS[head[8:12]]
+    raise HTTPException(status_code=415, detail="Unsupported file type: expected a PDF, JPEG, PNG, WEBP or HEIC/HEIF document.")
+
+
+def _declared_content_length(response: httpx.Response) -> int:
+    """Returns the Content-Length header as an int, treating a missing or unparseable value as 0."""
+    # A bogus header is simply ignored: the streaming byte budget still enforces the limit
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        
-        content_type = response.headers.get('Content-Type', 'image/jpeg')
-        if not content_type.startswith('image/') and not content_type.startswith('application/pdf'):
-            raise ValueError(f"Unsupported file type: {content_type}")
+        return int(response.headers.get('Content-Length', '0'))
+    except ValueError:
+        return 0
+
+
+async def _download_file(url: str) -> Tuple[bytes, str]:
+    """Streams the file into a single buffer and returns its raw bytes together with the sniffed MIME type."""
+    try:
+        async with app.state.http.stream("GET", url, timeout=10) as response:
+            response.raise_for_status()
             
-        base64_data = base64.b64encode(response.content).decode('utf-8')
-        
-        # Prepend the MIME type for the API
-        return f"data:{content_type};base64,{base64_data}"
+            # Fail fast on declared sizes, then enforce the same budget while streaming since the header can be absent or wrong
+            too_large = HTTPException(status_code=413, detail=f"Document exceeds the {MAX_DOWNLOAD_BYTES} byte download limit.")
+            if _declared_content_length(response) > MAX_DOWNLOAD_BYTES:
+                raise too_large
+            
+            # Chunks are appended straight into one growing buffer instead of being joined afterwards
+            file_bytes = bytearray()
+            mime_type = None
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                if len(file_bytes) + len(chunk) > MAX_DOWNLOAD_BYTES:
+                    raise too_large
+                file_bytes.extend(chunk)
+                # The Content-Type header is unreliable (octet-stream PDFs, HTML error pages served as 200),
+                # so the format is taken from the leading bytes as soon as they arrive
+                if mime_type is None and len(file_bytes) >= _SNIFF_LENGTH:
+                    mime_type = _sniff_mime_type(file_bytes)
+            
+        if mime_type is None:
+            mime_type = _sniff_mime_type(file_bytes)
+        return file_bytes, mime_type
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # Raise an HTTPException if the download fails (404, 403, network error)
         error_detail = f"DOCUMENT DOWNLOAD FAILED: URL {url[:50]}... returned error: {e}"
         print(f"DEBUG ERROR: {error_detail}")
         raise HTTPException(status_code=400, detail=error_detail)
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
 
 
-async def extract_data_with_llm(document_url: str) -> Dict[str, Any]:
-    """Calls the Gemini API using the multimodal document and strict JSON schema."""
-    # Check 1: API Key existence
-    if not API_KEY:
-        raise HTTPException(status_code=500, detail="API_KEY is missing in Render environment variables. Check Project Settings.")
+async def _download_and_cache(url: str) -> Tuple[bytes, str]:
+    """Downloads the file and memoizes it by URL when it fits in the download cache."""
+    downloaded = await _download_file(url)
+    if len(downloaded[0]) <= _DOWNLOAD_CACHE.maxsize:
+        _DOWNLOAD_CACHE[url] = downloaded
+    return downloaded
+
+
+def _forget_download(url: str, task: "asyncio.Task[Tuple[bytes, str]]") -> None:
+    """Done-callback: clears the in-flight entry and marks a failure as retrieved even if every caller left."""
+    if _DOWNLOADS_IN_FLIGHT.get(url) is task:
+        del _DOWNLOADS_IN_FLIGHT[url]
+    if not task.cancelled():
+        task.exception()
+
 
-    # 1. Download and encode the file 
-    base64_file_with_mime = _download_file_to_base64(document_url)
-    mime_type, base64_data = base64_file_with_mime.split(',', 1)
-    mime_type = mime_type.split(':')[1].split(';')[0]
+async def _download_file_cached(url: str) -> Tuple[bytes, str]:
+    """Serves recent downloads of the same URL from memory; concurrent misses for one URL share a single download."""
+    cached = _DOWNLOAD_CACHE.get(url)
+    if cached is not None:
+        return cached
     
-    # 2. Define the LLM instruction prompt
-    system_prompt = (
-        "You are a highly accurate invoice data extraction specialist. "
-        "Analyze the entire multi-page bill document and extract ALL line item details, quantities, rates, and amounts. "
-        "Strictly adhere to the provided JSON schema for the output. "
-        "The 'page_type' must be one of: 'Bill Detail', 'Final Bill', or 'Pharmacy'. "
-        "The 'document_final_total' must be the exact grand total amount written on the entire bill document."
+    # Every concurrent caller awaits the same task, so they share its result or its exception
+    task = _DOWNLOADS_IN_FLIGHT.get(url)
+    if task is None:
+        task = asyncio.create_task(_download_and_cache(url))
+        _DOWNLOADS_IN_FLIGHT[url] = task
+        task.add_done_callback(lambda done: _forget_download(url, done))
+    # Shielded so one caller going away (e.g. a client disconnect) doesn't cancel the download for the rest
+    return await asyncio.shield(task)
+
+
+def _content_digest(file_bytes: bytes) -> str:
+    """Returns a SHA-256 hex digest identifying the document content."""
+    # The 8-byte length prefix keeps the digest unambiguous across documents of different sizes.
+    # Feeding it separately avoids concatenating (and so copying) the whole document.
+    hasher = hashlib.sha256(len(file_bytes).to_bytes(8, "big"))
+    hasher.update(file_bytes)
+    return hasher.hexdigest()
+
+
+async def _upload_to_files_api(file_bytes: bytes, mime_type: str, digest: str) -> str:
+    """Uploads the document to the Gemini Files API and returns its file URI, retrying transient failures."""
+    # A failed attempt restarts the whole upload, since the resumable session may not have been created
+    async for attempt in _llm_retrying():
+        with attempt:
+            return await _upload_to_files_api_once(file_bytes, mime_type, digest)
+
+
+async def _upload_to_files_api_once(file_bytes: bytes, mime_type: str, digest: str) -> str:
+    """Runs one resumable upload: the first call announces the file, the second sends the bytes."""
+    start = await app.state.http.post(
+        f"{GEMINI_UPLOAD_URL}?key={API_KEY}",
+        headers={
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(file_bytes)),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+        },
+        json={"file": {"display_name": digest}},
     )
+    start.raise_for_status()
     
-    # 3. Construct the API payload
-    payload = {
-        "contents": [{
-            "parts": [
-                {"text": system_prompt},
-                {"inlineData": {"mimeType": mime_type, "data": base64_data}}
-            ]
-        }],
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "responseSchema": json.loads(LLMExtractionOutput.model_json_schema()) 
-        },
-        "systemInstruction": {"parts": [{"text": system_prompt}]}
-    }
+    upload = await app.state.http.post(
+        start.headers["X-Goog-Upload-URL"],
+        headers={"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+        content=bytes(file_bytes),
+    )
+    upload.raise_for_status()
+    return upload.json()["file"]["uri"]
+
+
+def _encode_base64(file_bytes: bytes) -> str:
+    """Base64-encodes the document for an inlineData part."""
+    return base64.b64encode(file_bytes).decode('ascii')
+
+
+def _files_api_cache_key(digest: str) -> str:
+    """Builds the cache key for an uploaded file's URI; files belong to the project behind API_KEY."""
+    return f"files-api:{_API_KEY_ID}:{digest}"
+
+
+async def _document_part(file_bytes: bytes, mime_type: str, digest: str) -> Tuple[Dict[str, Any], bool]:
+    """Builds the Gemini content part for the document (inline for small files, a Files API reference otherwise)
+    and reports whether the file URI was reused from the cache."""
+    if len(file_bytes) < FILES_API_MIN_BYTES:
+        base64_data = await run_in_threadpool(_encode_base64, file_bytes)
+        return {"inlineData": {"mimeType": mime_type, "data": base64_data}}, False
     
-    # 4. Make the API call with exponential backoff for robustness
-    max_retries = 3
-    response = None
-    for attempt in range(max_retries):
+    # Large documents are uploaded once and referenced by URI until Gemini expires the file
+    file_cache_key = _files_api_cache_key(digest)
+    file_uri = await run_in_threadpool(_EXTRACTION_CACHE.get, file_cache_key)
+    from_cache = file_uri is not None
+    if not from_cache:
+        file_uri = await _upload_to_files_api(file_bytes, mime_type, digest)
+        await run_in_threadpool(_EXTRACTION_CACHE.set, file_cache_key, file_uri, expire=FILES_API_URI_TTL)
+    return {"fileData": {"mimeType": mime_type, "fileUri": file_uri}}, from_cache
+
+
+def _is_retryable_llm_error(exc: BaseException) -> bool:
+    """Rate limits, gateway errors and dropped connections are worth another attempt."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in LLM_RETRYABLE_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+_llm_backoff = wait_exponential_jitter(initial=1, max=LLM_MAX_RETRY_WAIT)
+
+def _llm_retry_wait(retry_state: RetryCallState) -> float:
+    """Honours Gemini's Retry-After header when present, otherwise backs off exponentially with jitter."""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(float(retry_after), LLM_MAX_RETRY_WAIT)
+    return _llm_backoff(retry_state)
+
+
+def _llm_retrying() -> AsyncRetrying:
+    """Retry policy shared by every call to the Gemini API."""
+    return AsyncRetrying(
+        stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+        wait=_llm_retry_wait,
+        retry=retry_if_exception(_is_retryable_llm_error),
+        reraise=True,
+    )
+
+
+async def _post_to_gemini(payload: Dict[str, Any]) -> httpx.Response:
+    """POSTs the payload to Gemini, retrying transient failures without blocking the event loop."""
+    # Serialized once (not per attempt) with orjson; the base64 document dominates the body size
+    body = orjson.dumps(payload)
+    async for attempt in _llm_retrying():
+        with attempt:
+            response = await app.state.http.post(
+                GEMINI_API_URL,
+                headers={'Content-Type': 'application/json'},
+                content=body
+            )
+            response.raise_for_status()
+    return response
+
+
+def _split_pdf_pages(file_bytes: bytes) -> List[bytes]:
+    """Splits a multi-page PDF into one standalone PDF per page; returns [] when there is nothing to split."""
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+        page_count = len(reader.pages)
+        if page_count < 2:
+            return []
+        if page_count > MAX_FANOUT_PAGES:
+            # Each page is a separately billed call that resends the prompt and schema, so long
+            # documents go to Gemini in one call instead
+            print(f"DEBUG WARNING: {page_count} pages exceeds MAX_FANOUT_PAGES, sending whole document")
+            return []
+        
+        # pypdf copies shared resources (fonts, images) into every page, so the split output can be many
+        # times the original; past this budget the split would defeat the download size limit
+        max_split_bytes = min(FANOUT_MAX_SIZE_RATIO * len(file_bytes), MAX_DOWNLOAD_BYTES)
+        split_bytes = 0
+        page_pdfs = []
+        for page in reader.pages:
+            writer = PdfWriter()
+            writer.add_page(page)
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            split_bytes += buffer.tell()
+            if split_bytes > max_split_bytes:
+                print("DEBUG WARNING: split pages exceed the size budget, sending whole document")
+                return []
+            page_pdfs.append(buffer.getvalue())
+        return page_pdfs
+    
+    except Exception as e:
+        # Encrypted or malformed PDFs are still sent to Gemini as a single document. Besides PyPdfError,
+        # pypdf raises plain built-in exceptions (e.g. ValueError "Invalid page object") on damaged files,
+        # and splitting is only an optimisation, so any failure falls back to the whole document.
+        print(f"DEBUG WARNING: PDF split failed, sending whole document: {e}")
+        return []
+
+
+def _build_payload(document_part: Dict[str, Any]) -> Dict[str, Any]:
+    """Wraps a document part in the pre-built static parts of the Gemini payload."""
+    # The prompt travels only once, in systemInstruction; contents carry just the document
+    return {**_BASE_PAYLOAD, "contents": [{"parts": [document_part]}]}
+
+
+def _parse_gemini_reply(body: bytes) -> Tuple[_LLMExtractionOutputStruct, Dict[str, int]]:
+    """Decodes a generateContent response body into the structured extraction and its token usage."""
+    result = orjson.loads(body)
+    extracted_json_text = result['candidates'][0]['content']['parts'][0]['text']
+    usage_metadata = result.get('usageMetadata', {})
+    token_usage = {
+        "input_tokens": usage_metadata.get('promptTokenCount', 0),
+        "output_tokens": usage_metadata.get('candidatesTokenCount', 0),
+    }
+    return _LLM_OUTPUT_DECODER.decode(extracted_json_text), token_usage
+
+
+async def _call_gemini(file_bytes: bytes, mime_type: str, digest: str) -> Tuple[_LLMExtractionOutputStruct, Dict[str, int]]:
+    """Runs one generateContent call for a document (or a single page) and decodes the structured reply."""
+    # The semaphore caps concurrent Gemini calls across all requests to respect the API quota
+    async with app.state.llm_semaphore:
+        document_part, uri_from_cache = await _document_part(file_bytes, mime_type, digest)
         try:
-            response = requests.post(
-                GEMINI_API_URL, 
-                headers={'Content-Type': 'application/json'}, 
-                data=json.dumps(payload),
-                timeout=120 
+            # Transient failures are retried inside _post_to_gemini
+            response = await _post_to_gemini(_build_payload(document_part))
+        except httpx.HTTPStatusError as e:
+            # A cached file URI can go stale (file deleted early, API key moved to another project);
+            # Gemini then answers 4xx, so the URI is dropped and the document re-uploaded once. A URI uploaded
+            # during this call is fresh, so a 4xx then is a real request error and is not worth another upload
+            status_code = e.response.status_code
+            if not uri_from_cache or not 400 <= status_code < 500 or status_code == 429:
+                raise
+            await run_in_threadpool(_EXTRACTION_CACHE.delete, _files_api_cache_key(digest))
+            document_part, _ = await _document_part(file_bytes, mime_type, digest)
+            response = await _post_to_gemini(_build_payload(document_part))
+    
+    # Parsing long multi-page replies holds the GIL, so it runs on the threadpool rather than the event loop
+    return await run_in_threadpool(_parse_gemini_reply, response.content)
+
+
+async def _call_gemini_per_page(page_pdfs: List[bytes], mime_type: str) -> List[Tuple[_LLMExtractionOutputStruct, Dict[str, int]]]:
+    """Runs one Gemini call per page concurrently; if any page fails, the remaining calls are cancelled."""
+    # hashlib releases the GIL on large buffers, so the page digests are computed in parallel off the loop
+    page_digests = await asyncio.gather(*[run_in_threadpool(_content_digest, page_bytes) for page_bytes in page_pdfs])
+    tasks = [
+        asyncio.create_task(_call_gemini(page_bytes, mime_type, page_digest))
+        for page_bytes, page_digest in zip(page_pdfs, page_digests)
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other pages so they release their semaphore slots and quota, and collect
+        # their outcomes so no exception is left unretrieved
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def extract_data_with_llm(document_url: str) -> Dict[str, Any]:
+    """Calls the Gemini API using the multimodal document and strict JSON schema."""
+    # Check 1: API Key existence
+    if not API_KEY:
+        raise HTTPException(status_code=500, detail="API_KEY is missing in Render environment variables. Check Project Settings.")
+
+    # 1. Download the file and serve repeats of the same document from the cache
+    file_bytes, mime_type = await _download_file_cached(document_url)
+    # Hashing a multi-megabyte document off the loop keeps other requests responsive
+    digest = await run_in_threadpool(_content_digest, file_bytes)
+    cache_key = f"{GEMINI_MODEL}:{PROMPT_VERSION}:{digest}"
+    # diskcache does blocking SQLite/file I/O (and may wait on other workers' writes), so it runs on the threadpool
+    cached_json = await run_in_threadpool(_EXTRACTION_CACHE.get, cache_key)
+    if cached_json is not None:
+        return {
+            "extracted_data": await run_in_threadpool(_LLM_OUTPUT_DECODER.decode, cached_json),
+            "token_usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+        }
+
+    # 2. Multi-page PDFs are fanned out into one concurrent call per page
+    page_pdfs = []
+    if mime_type == "application/pdf":
+        page_pdfs = await run_in_threadpool(_split_pdf_pages, file_bytes)
+
+    try:
+        # 3. Make the API call(s)
+        if page_pdfs:
+            results = await _call_gemini_per_page(page_pdfs, mime_type)
+            # Each call only saw one page, so page numbers are restored from the split order
+            pagewise_line_items = []
+            for page_no, (page_output, _) in enumerate(results, start=1):
+                for page in page_output.pagewise_line_items:
+                    page.page_no = str(page_no)
+                    pagewise_line_items.append(page)
+            extracted_data = _LLMExtractionOutputStruct(
+                pagewise_line_items=pagewise_line_items,
+                # The grand total is printed on the last page of the bill
+                document_final_total=results[-1][0].document_final_total,
             )
-            response.raise_for_status() 
-            
-            result = response.json()
-            
-            # 5. Extract JSON and Token Usage
-            extracted_json_text = result['candidates'][0]['content']['parts'][0]['text']
-            extracted_data = json.loads(extracted_json_text)
-            
-            usage_metadata = result.get('usageMetadata', {})
-            input_tokens = usage_metadata.get('promptTokenCount', 0)
-            output_tokens = usage_metadata.get('candidatesTokenCount', 0)
-            
-            return {
-                "extracted_data": extracted_data,
-                "token_usage": {
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "total_tokens": input_tokens + output_tokens
-                }
-            }
+            usages = [usage for _, usage in results]
+        else:
+            extracted_data, usage = await _call_gemini(file_bytes, mime_type, digest)
+            usages = [usage]
 
-        except requests.exceptions.RequestException as e:
-            if response is not None and response.status_code == 429 and attempt < max_retries - 1:
-                # Handle rate limiting with exponential backoff
-                delay = 2 ** attempt
-                time.sleep(delay)
-                continue
-            
-            # Catch authentication errors (400, 403) and forward them
-            error_detail = response.json().get('error', {}).get('message', 'Unknown API Error') if response is not None else str(e)
-            raise HTTPException(status_code=response.status_code if response is not None else 500, detail=f"LLM API Error: {error_detail}")
-        except (KeyError, IndexError, json.JSONDecodeError, AttributeError) as e:
-            error_detail = f"LLM returned invalid or unexpected structure: {e}"
-            raise HTTPException(status_code=500, detail=error_detail)
+        # 4. Only decoded, schema-valid output reaches the cache
+        await run_in_threadpool(
+            _EXTRACTION_CACHE.set, cache_key, msgspec.json.encode(extracted_data), expire=EXTRACTION_CACHE_TTL
+        )
         
-    raise HTTPException(status_code=503, detail="LLM API failed after multiple retries.")
+        input_tokens = sum(usage["input_tokens"] for usage in usages)
+        output_tokens = sum(usage["output_tokens"] for usage in usages)
+        return {
+            "extracted_data": extracted_data,
+            "token_usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens
+            }
+        }
+
+    except httpx.HTTPStatusError as e:
+        # Non-retryable errors (400, 403) and retries that ran out are forwarded as-is
+        # Gateways in front of Gemini may answer with HTML or plain text, so the body is parsed defensively
+        try:
+            error_detail = e.response.json().get('error', {}).get('message', 'Unknown API Error')
+        except (ValueError, AttributeError):
+            error_detail = (e.response.text or str(e))[:500]
+        raise HTTPException(status_code=e.response.status_code, detail=f"LLM API Error: {error_detail}")
+    except httpx.HTTPError as e:
+        # Network-level failures (timeouts, connection resets) carry no response body
+        raise HTTPException(status_code=500, detail=f"LLM API Error: {e}")
+    except (KeyError, IndexError, json.JSONDecodeError, AttributeError, msgspec.DecodeError) as e:
+        error_detail = f"LLM returned invalid or unexpected structure: {e}"
+        raise HTTPException(status_code=500, detail=error_detail)
 
 
 # --- API INSTANCE AND ENDPOINT ---
 
-app = FastAPI(title="HackRx Bill Extraction API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens one pooled HTTP/2 client for the app's lifetime so TLS connections are reused, and the Gemini concurrency limit."""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        # Keep idle connections well past httpx's 5s default so sparse traffic still reuses TLS sessions
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+    )
+    app.state.llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    # CPU-bound steps (hashing, base64, PDF splitting, reply parsing) and diskcache I/O run on the shared anyio threadpool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+app = FastAPI(title="HackRx Bill Extraction API", version="1.0.0", lifespan=lifespan)
 
-@app.post("/extract-bill-data", response_model=ExtractionResponse, status_code=200)
+# No response_model: the response is built locally from validated data, so FastAPI's re-validation
+# pass is skipped. ExtractionResponse is still declared for the OpenAPI docs.
+@app.post("/extract-bill-data", status_code=200, responses={200: {"model": ExtractionResponse}})
 async def extract_bill_data(request: ExtractionRequest):
     """
     Processes a document URL, extracts line items, calculates final totals, and returns the structured JSON.
     """
-    document_url = request.document
+    document_url = str(request.document)
     
     try:
         # Step 1: Call the LLM/IDP Service
         llm_output = await extract_data_with_llm(document_url)
         
-        # Pydantic validation ensures the structure is correct here
-        extracted_data = LLMExtractionOutput(**llm_output["extracted_data"])
+        # Already decoded and validated against the LLMExtractionOutput shape by extract_data_with_llm
+        extracted_data: _LLMExtractionOutputStruct = llm_output["extracted_data"]
         token_usage_counts = llm_output["token_usage"]
 
         # Step 2: Post-processing, Aggregation, and Validation (CRITICAL LOGIC)
-        
-        cumulative_extracted_total: float = 0.0
-        cumulative_item_count: int = 0
-        pagewise_output: List[PagewiseLineItem] = []
-        
-        # This loop guarantees the final total is the sum of extracted line items
-        for page in extracted_data.pagewise_line_items:
-            page_sum = 0.0
-            
-            # Accumulate sum and count
-            for item in page.bill_items:
-                page_sum += item.item_amount
-                cumulative_item_count += 1
 
-            # Accumulate the sum of line items across all pages
-            cumulative_extracted_total += page_sum
-            
-            pagewise_output.append(page) # Append the validated page data
+        pages = extracted_data.pagewise_line_items
+        cumulative_item_count = sum(len(page.bill_items) for page in pages)
+        # This guarantees the final total is the sum of extracted line items; fsum avoids float drift
+        cumulative_extracted_total = math.fsum(item.item_amount for page in pages for item in page.bill_items)
 
         # Step 3: Construct the final response
-        response_data = ExtractionResponse(
-            is_success=True,
-            token_usage=TokenUsage(**token_usage_counts),
-            data=ExtractionData(
-                pagewise_line_items=pagewise_output,
-                final_total_extracted=round(cumulative_extracted_total, 2), # FINAL REQUIRED CALCULATION
-                total_item_count=cumulative_item_count,
-            )
-        )
-        return response_data
+        # Built as plain data in the ExtractionResponse shape: every value here was computed or validated
+        # above, so no Pydantic models are constructed. msgspec encodes the page structs natively.
+        response_data = {
+            "is_success": True,
+            "token_usage": {
+                "total_tokens": token_usage_counts["total_tokens"],
+                "input_tokens": token_usage_counts["input_tokens"],
+                "output_tokens": token_usage_counts["output_tokens"],
+            },
+            "data": {
+                "pagewise_line_items": pages,
+                "final_total_extracted": round(cumulative_extracted_total, 2), # FINAL REQUIRED CALCULATION
+                "total_item_count": cumulative_item_count,
+                "sub_total_extracted": None,
+            },
+        }
+        return Response(content=msgspec.json.encode(response_data), media_type="application/json")
 
     except HTTPException as e:
         # This catches all deliberate errors (API Key missing, Download failure, LLM auth errors)